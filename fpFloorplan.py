@@ -1,27 +1,47 @@
 from sklearn.manifold import Isomap
-from sklearn.neighbors import KNeighborsClassifier, RadiusNeighborsClassifier
+from sklearn.neighbors import KNeighborsClassifier, BallTree
 import matplotlib.pyplot as plt
 import numpy as np
+import pickle
 
 class FloorplanEstimator:
     """
     Simple estimator for rough floorplans
     """
-    def __init__(self):
+    def __init__(self, n_landmarks=400, random_state=0):
         """
         Instantiate floorplan estimator
+        :param n_landmarks: number of fingerprints used as Isomap landmarks
+        :param random_state: seed for landmark selection
         """
-        self.dimred = Isomap(n_neighbors=25, n_components=2)
+        self.dimred = Isomap(n_neighbors=25, n_components=2, neighbors_algorithm='ball_tree', n_jobs=-1)
+        self.n_landmarks = n_landmarks
+        self.random_state = random_state
         self._fingerprints = None
         self._label = None
+        self._landmarks = None
+        self._landmark_pinv = None
+        self._landmark_mean = None
 
     def fit(self, fingerprints, label):
         """
         Estimate floorplan from labeled fingerprints
+
+        Isomap is only fit on a random subset of landmark fingerprints, the
+        remaining fingerprints are embedded by triangulation (Landmark Isomap).
         :param fingerprints: list of fingerprints
         :param label: list of corresponding labels
         """
-        self.dimred.fit(fingerprints)
+        fingerprints = np.asarray(fingerprints, dtype=np.float64)
+        n = fingerprints.shape[0]
+        if n > self.n_landmarks:
+            rng = np.random.RandomState(self.random_state)
+            self._landmarks = np.sort(rng.choice(n, self.n_landmarks, replace=False))
+        else:
+            self._landmarks = np.arange(n)
+        self.dimred.fit(fingerprints[self._landmarks])
+        self._landmark_pinv = np.linalg.pinv(self.dimred.embedding_)
+        self._landmark_mean = (self.dimred.dist_matrix_ ** 2).mean(axis=0)
         self._fingerprints = fingerprints
         self._label = label
 
@@ -31,21 +51,56 @@ class FloorplanEstimator:
         :param fingerprints: list of fingerprints
         :return: list of [x,y] coordinates
         """
-        return self.dimred.transform(fingerprints)
+        fingerprints = np.asarray(fingerprints, dtype=np.float64)
+        # Geodesic distance to landmarks via the nearest landmarks in the graph
+        dist, ind = self.dimred.nbrs_.kneighbors(fingerprints, return_distance=True)
+        geodesic = dist[:, 0, None] + self.dimred.dist_matrix_[ind[:, 0]]
+        for k in range(1, ind.shape[1]):
+            np.minimum(geodesic, dist[:, k, None] + self.dimred.dist_matrix_[ind[:, k]], out=geodesic)
+        return -0.5 * (geodesic ** 2 - self._landmark_mean).dot(self._landmark_pinv.T)
+
+    def save(self, filename):
+        """
+        Save the fitted floorplan, including the Isomap geodesic graph
+        :param filename: filename (.p)
+        """
+        with open(filename, 'wb') as outfile:
+            pickle.dump(self.__dict__, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a floorplan saved with save() without refitting Isomap
+        :param filename: filename (.p)
+        :return: FloorplanEstimator
+        """
+        with open(filename, 'rb') as infile:
+            state = pickle.load(infile)
+        estimator = cls.__new__(cls)
+        estimator.__dict__.update(state)
+        return estimator
 
     def draw(self):
         """
         Draw the estimated floorplan in the current figure
         """
-        xy = self.dimred.transform(self._fingerprints)
+        xy = self.transform(self._fingerprints)
 
         x_min, x_max = xy[:,0].min(), xy[:,0].max()
         y_min, y_max = xy[:,1].min(), xy[:,1].max()
         xx, yy = np.meshgrid(np.arange(x_min, x_max, 1.0),
                              np.arange(y_min, y_max, 1.0))
-        clf = RadiusNeighborsClassifier(radius=3.0, outlier_label=0)
-        clf.fit(xy, self._label)
-        label = clf.predict(np.c_[xx.ravel(), yy.ravel()]).reshape(xx.shape)
+        cells = np.c_[xx.ravel(), yy.ravel()]
+        radius = 3.0
+        # Only run the radius query on cells that have a fingerprint nearby
+        tree = BallTree(xy)
+        dist, _ = tree.query(cells, k=1)
+        mask = dist[:, 0] <= radius
+        classes, label_idx = np.unique(self._label, return_inverse=True)
+        label = np.zeros(cells.shape[0], dtype=classes.dtype)
+        ind = tree.query_radius(cells[mask], r=radius)
+        label[mask] = classes[[np.bincount(label_idx[i], minlength=len(classes)).argmax() for i in ind]]
+        label = label.reshape(xx.shape)
 
         plt.pcolormesh(xx, yy, label)
         plt.scatter(xy[:,0], xy[:,1], c=self._label, vmin=0)
\ No newline at end of file
@@ -3,11 +3,45 @@ fpLocalize
 
 Perform localization using RSSI fingerprints
 """
-from sklearn.decomposition import PCA
-from sklearn.neighbors import KNeighborsClassifier
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.decomposition import PCA, TruncatedSVD
+try:
+    from sklearnex.neighbors import KNeighborsClassifier
+except ImportError:
+    from sklearn.neighbors import KNeighborsClassifier
+try:
+    import cudf
+    from cuml.neighbors import KNeighborsClassifier as CuKNeighborsClassifier
+except ImportError:
+    cudf = None
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 def _make_unique(mylist):
-    return list(set(mylist))
+    return list(dict.fromkeys(mylist))
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _scatter_rows(out, cols, vals, offsets):
+        for i in prange(offsets.shape[0] - 1):
+            for k in range(offsets[i], offsets[i + 1]):
+                out[i, cols[k]] = vals[k]
+else:
+    def _scatter_rows(out, cols, vals, offsets):
+        rows = np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+        out[rows, cols] = vals
+
+def _fingerprint_dtype(vals, undetected_value):
+    # int16 is only used when it holds every value exactly, fractional RSSI is kept as float32
+    if np.issubdtype(vals.dtype, np.integer) and float(undetected_value).is_integer():
+        return np.int16
+    return np.float32
+
+def _as_float32(fingerprints):
+    return np.ascontiguousarray(fingerprints, dtype=np.float32)
 
 
 class FingerprintGenerator:
@@ -35,7 +69,7 @@ class FingerprintGenerator:
         if method == 'fixed' and not beacons:
             raise Exception('Beacons have to be provided when using a fixed set of beacons!')
         self._set_method(method)
-        self._beacons = beacons
+        self._set_beacons(beacons)
         self._undetected_value = undetected_value
 
 
@@ -77,16 +111,59 @@ class FingerprintGenerator:
                 },
                 ...
             ]
-        :return: list of fingerprints
+        :return: array of fingerprints (n_observations x n_beacons). The array is int16 if all RSSI values
+            and the undetected value are integers, float32 otherwise.
+        """
+        return self.transform_encoded(*self.encode(rssi))
+
+    def encode(self, rssi):
         """
-        tf = []
+        Encode list of RSSI observations as beacon columns and values (CSR layout)
+        :param rssi: list of rssi observations per device, see transform()
+        :return: cols, vals, offsets. The beacons of observation i are cols[offsets[i]:offsets[i+1]],
+            with RSSI values vals[offsets[i]:offsets[i+1]]. Unknown beacons are dropped.
+        """
+        beacon_to_col = self._beacon_to_col
+        duplicate_cols = self._duplicate_cols
+        cols, vals, offsets = [], [], [0]
         for observation in rssi:
-            tf.append([])
-            for beacon in self._beacons:
-                if beacon in observation:
-                    tf[-1].append(observation[beacon])
-                else:
-                    tf[-1].append(self._undetected_value)
+            for beacon, value in observation.items():
+                col = beacon_to_col.get(beacon)
+                if col is not None:
+                    cols.append(col)
+                    vals.append(value)
+            if duplicate_cols:
+                # Beacons listed more than once fill each of their columns
+                for beacon, extra_cols in duplicate_cols.items():
+                    if beacon in observation:
+                        cols.extend(extra_cols)
+                        vals.extend([observation[beacon]] * len(extra_cols))
+            offsets.append(len(cols))
+        vals = np.array(vals) if vals else np.zeros(0, dtype=np.int16)
+        vals = vals.astype(np.int16 if np.issubdtype(vals.dtype, np.integer) else np.float32)
+        return (np.array(cols, dtype=np.intp),
+                vals,
+                np.array(offsets, dtype=np.intp))
+
+    def transform_encoded(self, cols, vals, offsets):
+        """
+        Transform encoded RSSI observations into fingerprints
+        :param cols, vals, offsets: encoded observations, see encode()
+        :return: array of fingerprints (n_observations x n_beacons)
+        """
+        cols = np.ascontiguousarray(cols, dtype=np.intp)
+        vals = np.ascontiguousarray(vals)
+        offsets = np.ascontiguousarray(offsets, dtype=np.intp)
+        # The scatter kernel does not check bounds, validate the encoding first
+        if offsets.ndim != 1 or len(offsets) == 0 or offsets[0] != 0 or np.any(np.diff(offsets) < 0):
+            raise Exception('Offsets must start at 0 and be non-decreasing!')
+        if cols.ndim != 1 or len(cols) != len(vals) or len(cols) != offsets[-1]:
+            raise Exception('Number of columns and values must match the last offset!')
+        if len(cols) and (cols.min() < 0 or cols.max() >= len(self._beacons)):
+            raise Exception('Beacon columns out of range!')
+        tf = np.full((len(offsets) - 1, len(self._beacons)), self._undetected_value,
+                     dtype=_fingerprint_dtype(vals, self._undetected_value))
+        _scatter_rows(tf, cols, vals, offsets)
         return tf
 
 
@@ -95,20 +172,23 @@ class FingerprintGenerator:
             raise Exception('Unknown fit method: {}!'.format(method))
         self._method = method
 
+    def _set_beacons(self, beacons):
+        self._beacons = tuple(beacons) if beacons else ()
+        beacon_to_cols = {}
+        for i, b in enumerate(self._beacons):
+            beacon_to_cols.setdefault(b, []).append(i)
+        self._beacon_to_col = {b: c[0] for b, c in beacon_to_cols.items()}
+        self._duplicate_cols = {b: c[1:] for b, c in beacon_to_cols.items() if len(c) > 1}
+
     def _fit_always_visible(self, rssi):
-        beacons = rssi[0].keys()
-        for observation in rssi:
-            for beacon in beacons:
-                if beacon not in observation.keys():
-                    beacons.remove(beacon)
-        self._beacons = _make_unique(beacons)
+        beacons = set(rssi[0])
+        for observation in rssi[1:]:
+            beacons.intersection_update(observation)
+        # Keep the order of the first observation so the columns are deterministic
+        self._set_beacons([beacon for beacon in rssi[0] if beacon in beacons])
 
     def _fit_all(self, rssi):
-        beacons = []
-        for observation in rssi:
-            for beacon in observation.keys():
-                beacons.append(beacon)
-        self._beacons = _make_unique(beacons)
+        self._set_beacons(_make_unique(beacon for observation in rssi for beacon in observation))
 
 
 
@@ -123,15 +203,32 @@ class RoomClassifier:
     the fingerprints are outliers.
 
     This class is a simple wrapper around sklearn's PCA and KNeighborsClassifier.
+    With use_gpu, the nearest neighbor search runs on the GPU using cuML.
+    When few beacons are detected per fingerprint, PCA is replaced by a
+    TruncatedSVD on sparse fingerprints relative to the undetected value.
     """
-    def __init__(self, outlier_threshold=10.0):
+    def __init__(self, outlier_threshold=10.0, use_gpu=False, undetected_value=-100, sparse_density=0.1):
         """
         Instantiate room classifier
         :param outlier_threshold: Threshold in dB for outlier detection
+        :param use_gpu: use cuML's KNeighborsClassifier (requires cudf and cuml)
+        :param undetected_value: value assigned to unobserved beacons in the fingerprints
+        :param sparse_density: use sparse fingerprints if the fraction of detected beacons is below this value
         """
-        self.dimred = PCA(n_components=5)
-        self.classifier = KNeighborsClassifier(n_neighbors=5)
+        if use_gpu and cudf is None:
+            raise Exception('cudf and cuml are required when using the GPU!')
+        self._pca = PCA(n_components=5, svd_solver='randomized', iterated_power=4, random_state=0)
+        self._svd = TruncatedSVD(n_components=5, random_state=0)
+        self.dimred = self._pca
+        if use_gpu:
+            self.classifier = CuKNeighborsClassifier(n_neighbors=5)
+        else:
+            self.classifier = KNeighborsClassifier(n_neighbors=5, algorithm='brute', n_jobs=-1)
         self.outlier_threshold = outlier_threshold
+        self.use_gpu = use_gpu
+        self.undetected_value = undetected_value
+        self.sparse_density = sparse_density
+        self._sparse = False
 
     def fit(self, fingerprints, label):
         """
@@ -139,8 +236,14 @@ class RoomClassifier:
         :param fingerprints: list of fingerprints
         :param label: list of labels corresponding to fingerprints
         """
-        fp = self.dimred.fit_transform(fingerprints)
-        self.classifier.fit(fp, label)
+        fp = _as_float32(fingerprints)
+        self._sparse = np.mean(fp != self.undetected_value) < self.sparse_density
+        self.dimred = self._svd if self._sparse else self._pca
+        if self._sparse:
+            fp = self._to_sparse(fp)
+        fp = self.dimred.fit_transform(fp)
+        self.classifier.fit(self._to_device(fp), label)
+        self._classes, self._label_idx = np.unique(label, return_inverse=True)
 
     def predict(self, fingerprints):
         """
@@ -148,18 +251,57 @@ class RoomClassifier:
         :param fingerprints: list of fingerprints
         :return: list of room labels
         """
-        fp = self.dimred.transform(fingerprints)
-        return self.classifier.predict(fp)
+        fp = self._project(fingerprints)
+        return self._to_host(self.classifier.predict(self._to_device(fp)))
 
     def predict_outlier(self, fingerprints):
         """
         Predict whether the fingerprints are taken in an unlabeled room
+
+        Pass fingerprints in batches where possible, every call has a fixed overhead.
+        :param fingerprints: list of fingerprints, or a single fingerprint
+        :return: array of booleans, True if the room is unlabeled, False otherwise
+        """
+        fp = self._project(fingerprints)
+        dist, ind = self.classifier.kneighbors(self._to_device(fp), n_neighbors=1, return_distance=True)
+        return self._to_host(dist)[:, 0] > self.outlier_threshold
+
+    def predict_with_outlier(self, fingerprints):
+        """
+        Predict room label and outlier status using a single neighbor search
         :param fingerprints: list of fingerprints
-        :return: list of booleans, True if the room is unlabeled, False otherwise
+        :return: list of room labels, list of booleans (see predict_outlier)
         """
-        fp = self.dimred.transform(fingerprints)
-        dist, ind = self.classifier.kneighbors(fp, n_neighbors=1, return_distance=True)
-        return (dist > self.outlier_threshold).reshape(-1)
+        fp = self._project(fingerprints)
+        dist, ind = self.classifier.kneighbors(self._to_device(fp), n_neighbors=self.classifier.n_neighbors,
+                                               return_distance=True)
+        dist, ind = self._to_host(dist), self._to_host(ind)
+        votes = np.zeros((ind.shape[0], len(self._classes)), dtype=np.intp)
+        np.add.at(votes, (np.arange(ind.shape[0])[:, None], self._label_idx[ind]), 1)
+        label = self._classes[votes.argmax(axis=1)]
+        return label, dist[:, 0] > self.outlier_threshold
+
+    def _project(self, fingerprints):
+        fp = np.atleast_2d(_as_float32(fingerprints))
+        if self._sparse:
+            fp = self._to_sparse(fp)
+        return self.dimred.transform(fp)
+
+    def _to_sparse(self, fp):
+        # Only the detected entries are shifted, undetected ones become implicit zeros
+        rows, cols = np.nonzero(fp != self.undetected_value)
+        data = fp[rows, cols] - self.undetected_value
+        return csr_matrix((data, (rows, cols)), shape=fp.shape)
+
+    def _to_device(self, fp):
+        if self.use_gpu:
+            return cudf.DataFrame(np.asarray(fp, dtype=np.float32))
+        return fp
+
+    def _to_host(self, result):
+        if self.use_gpu:
+            return result.to_numpy()
+        return result
 
 
 
@@ -185,19 +327,19 @@ def _fingerprint_example():
     fixed = ['A', 'B', 'C']
     unobserved = -99
 
-    print 'FingerprintGenerator (fixed)'
+    print('FingerprintGenerator (fixed)')
     fp = FingerprintGenerator(method='fixed', undetected_value=unobserved, beacons=fixed)
-    print fp.transform(obs) # [[-10, -20, -30], [-99, -20, -30]]
+    print(fp.transform(obs)) # [[-10, -20, -30], [-99, -20, -30]]
 
-    print 'FingerprintGenerator (always_visible)'
+    print('FingerprintGenerator (always_visible)')
     fp = FingerprintGenerator(method='always_visible')
     fp.fit(obs)
-    print fp.transform(obs) # [[-30, -20], [-30, -20]]
+    print(fp.transform(obs)) # [[-20, -30], [-20, -30]]
 
-    print 'FingerprintGenerator (all)'
+    print('FingerprintGenerator (all)')
     fp = FingerprintGenerator(method='all')
     fp.fit(obs)
-    print fp.transform(obs) # [[-10, -30, -20, -100], [-100, -30, -20, -40]]
+    print(fp.transform(obs)) # [[-10, -20, -30, -100], [-100, -20, -30, -40]]
 
 
 def _room_example():
@@ -210,17 +352,17 @@ def _room_example():
         2
     ]
 
-    print 'Instantiate room classifier'
+    print('Instantiate room classifier')
     clf = RoomClassifier()
     clf.classifier.n_neighbors = 1 # Reduce neighbors for demonstration
-    print 'Train...'
+    print('Train...')
     clf.fit(fingerprints, label)
-    print 'Predict rooms 1 and 2...'
-    print clf.predict(fingerprints) # [1 2]
-    print 'Predict inliers'
-    print clf.predict_outlier(fingerprints) # [False False]
-    print 'Predict outlier'
-    print clf.predict_outlier([[0,0,0,0,0]]) # [True]
+    print('Predict rooms 1 and 2...')
+    print(clf.predict(fingerprints)) # [1 2]
+    print('Predict inliers')
+    print(clf.predict_outlier(fingerprints)) # [False False]
+    print('Predict outlier')
+    print(clf.predict_outlier([[0,0,0,0,0]])) # [True]
 
 
 if __name__ == '__main__':
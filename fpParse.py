@@ -4,8 +4,11 @@ fpParse.py
 Read previously recorded fingerprints.
 """
 
+import mmap
 import pickle
 
+import numpy as np
+
 def savePickledFingerprints(filename, fingerprints, label=None):
     """
     Save pickled fingerprints
@@ -16,9 +19,9 @@ def savePickledFingerprints(filename, fingerprints, label=None):
     """
     with open(filename, 'wb') as outfile:
         pickle.dump({
-            'fingerprints': fingerprints,
+            'fingerprints': np.asarray(fingerprints),
             'label': label
-        }, outfile)
+        }, outfile, protocol=pickle.HIGHEST_PROTOCOL)
 
 def loadPickledFingerprints(filename):
     """
@@ -26,10 +29,32 @@ def loadPickledFingerprints(filename):
     :param filename: filename (.p)
     :return: fingerprints, label
     """
-    with open(filename, 'rb') as infile:
-        data = pickle.load(infile)
+    data = _loadPickle(filename)
     return data['fingerprints'], data['label']
 
+def saveNumpyFingerprints(filename, fingerprints, label=None):
+    """
+    Save fingerprints as a compressed numpy archive
+    :param filename: filename (.npz)
+    :param fingerprints: list of fingerprints
+    :param label: list of labels (optional)
+    """
+    arrays = {'fingerprints': np.asarray(fingerprints)}
+    if label is not None:
+        arrays['label'] = np.asarray(label)
+    np.savez_compressed(filename, **arrays)
+
+def loadNumpyFingerprints(filename):
+    """
+    Load fingerprints from a numpy archive
+    :param filename: filename (.npz)
+    :return: fingerprints, label
+    """
+    with np.load(filename) as data:
+        fingerprints = data['fingerprints']
+        label = data['label'] if 'label' in data else None
+    return fingerprints, label
+
 
 
 def parseOldFingerprints(filename):
@@ -38,5 +63,17 @@ def parseOldFingerprints(filename):
     :param filename: Filename (.p)
     :return: data, label. Data is a list of fingerprints, label is a list of room labels.
     """
-    aggregator = pickle.load(open(filename,"rb"))
-    return aggregator.get_som_data()
\ No newline at end of file
+    aggregator = _loadPickle(filename)
+    return aggregator.get_som_data()
+
+
+def _loadPickle(filename):
+    # Unpickle straight from the page cache; latin1 decodes numpy data pickled by Python 2
+    with open(filename, 'rb') as infile:
+        try:
+            mm = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty or non-regular file, read it as a stream instead
+            return pickle.load(infile, encoding='latin1')
+        with mm:
+            return pickle.loads(mm, encoding='latin1')
\ No newline at end of file